@@ -9,38 +9,89 @@ Wersja z integracją Google Document AI (Invoice Parser).
 Uruchomienia:
   python process_invoices.py --once
   DRY_RUN=true python process_invoices.py --once
+  XLSX_ENGINE=openpyxl python process_invoices.py --once   # zapis przez openpyxl
   python process_invoices.py               # pętla co 5 min
 """
 
 from __future__ import annotations
 
 import os
+import re
 import sys
 import json
 import time
 import math
 import logging
 import argparse
-from dataclasses import dataclass, asdict
+import contextlib
+import functools
+import hashlib
+import shutil
+import signal
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from xml.sax.saxutils import escape as xml_escape
+from dataclasses import dataclass, fields
 from datetime import datetime
 from pathlib import Path
-from typing import List, Tuple, Dict, Any, Optional
+from typing import List, Tuple, Dict, Any, Optional, Sequence, Callable
+
+try:  # orjson (C) jest opcjonalny – bez niego DRY_RUN i credentials idą przez json
+    import orjson
+except Exception:
+    orjson = None
+
+if orjson is not None:
+    def _dumps(o: Any) -> str:
+        return orjson.dumps(o).decode()
+
+    def _loads(s: str) -> Any:
+        return orjson.loads(s)
+else:
+    def _dumps(o: Any) -> str:
+        return json.dumps(o, ensure_ascii=False)
+
+    def _loads(s: str) -> Any:
+        return json.loads(s)
 
 # =============== KONFIG ===============
 
-INBOX_DIR = Path(os.getenv("INBOX_DIR", "Skopiowane_faktury")).resolve()
-OUT_XLSX = Path(os.getenv("OUT_XLSX", "Szablon_Faktury_AI_v4.xlsx")).resolve()
+# Ścieżki rozwiązujemy leniwie (inbox_dir()/out_xlsx_path()) – resolve() robi
+# stat na każdym członie ścieżki, a nie ma sensu płacić za to przy samym imporcie.
+_INBOX_RAW = os.getenv("INBOX_DIR", "Skopiowane_faktury")
+_OUT_RAW = os.getenv("OUT_XLSX", "Szablon_Faktury_AI_v4.xlsx")
 LOOP_SLEEP_SEC = int(os.getenv("LOOP_SLEEP_SEC", "300"))  # 5 min
 DRY_RUN = os.getenv("DRY_RUN", "").lower() in {"1", "true", "yes"}
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+XLSX_ENGINE = os.getenv("XLSX_ENGINE", "raw").lower()  # "raw" | "openpyxl"
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", "8"))
+PARSE_EXECUTOR = os.getenv("PARSE_EXECUTOR", "thread").lower()  # "thread" (DocAI/IO) | "process" (CPU)
 
 # Google Document AI (opcjonalnie, włącz jeśli masz sekrety/zależności)
 DOC_AI_PROJECT = os.getenv("DOC_AI_PROJECT")          # np. "my-project"
 DOC_AI_LOCATION = os.getenv("DOC_AI_LOCATION", "eu")  # np. "eu"
 DOC_AI_PROCESSOR = os.getenv("DOC_AI_PROCESSOR")      # np. "1234567890abcdef"
 GOOGLE_APPLICATION_CREDENTIALS_JSON = os.getenv("GOOGLE_APPLICATION_CREDENTIALS_JSON")
+# Tryb wsadowy (batch_process_documents) – wymaga google-cloud-storage i dwóch prefiksów GCS
+DOCAI_GCS_IN = os.getenv("DOCAI_GCS_IN")              # np. "gs://bucket/faktury-in"
+DOCAI_GCS_OUT = os.getenv("DOCAI_GCS_OUT")            # np. "gs://bucket/faktury-out"
+DOCAI_BATCH_THRESHOLD = int(os.getenv("DOCAI_BATCH_THRESHOLD", "5"))
+DOCAI_BATCH_TIMEOUT_SEC = int(os.getenv("DOCAI_BATCH_TIMEOUT_SEC", "900"))
+
+# obie wielkości liter z góry – typowe nazwy trafiają bez .lower()
+SUPPORTED_EXT = frozenset(
+    ext for base in (".pdf", ".jpg", ".jpeg", ".png") for ext in (base, base.upper())
+)
 
-SUPPORTED_EXT = {".pdf", ".jpg", ".jpeg", ".png"}
+@functools.lru_cache(maxsize=1)
+def inbox_dir() -> Path:
+    return Path(_INBOX_RAW).resolve()
+
+@functools.lru_cache(maxsize=1)
+def out_xlsx_path() -> Path:
+    return Path(_OUT_RAW).resolve()
 
 # =============== LOGGING ===============
 
@@ -52,7 +103,7 @@ log = logging.getLogger("process_invoices")
 
 # =============== MODELE DANYCH ===============
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class LineItem:
     description: str
     quantity: float
@@ -63,7 +114,7 @@ class LineItem:
     gross: float
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Invoice:
     number: str
     issue_date: str  # ISO yyyy-mm-dd
@@ -74,6 +125,7 @@ class Invoice:
     total_vat: float
     total_gross: float
     line_items: List[LineItem]
+    is_stub: bool = False  # dane z parse_invoice_stub – sumy zgodne z definicji
 
     def as_header_row(self) -> Dict[str, Any]:
         return {
@@ -89,76 +141,196 @@ class Invoice:
 
 # =============== WALIDACJA SUM ===============
 
-def validate_totals(data: Dict[str, Any], tol: float = 0.01) -> Tuple[bool, List[str]]:
-    total_net = float(data.get("total_net", 0) or 0)
-    total_vat = float(data.get("total_vat", 0) or 0)
-    total_gross = float(data.get("total_gross", 0) or 0)
+# Sumy liczymy na floatach (math.fsum – dokładnie, bez dryfu), a do groszy (int)
+# zamieniamy dopiero sumę i total: zaokrąglanie każdej pozycji osobno kumuluje
+# błąd (4 × 10.125 dałoby 40.48 zamiast 40.50). Tolerancja 0.01 PLN = 1 grosz.
+SCALE = 100
+
+# Poniżej tej liczby pozycji narzut wywołania funkcji JIT przewyższa zysk.
+NUMBA_MIN_ITEMS = 32
+
+def _sum3_py(arr):
+    # arr: (N, 3) float64 – wiersz po wierszu, ciągły odczyt pamięci;
+    # kompilowane przez njit w _jit_sum3 (na poziomie modułu, żeby cache=True działało)
+    s0 = s1 = s2 = 0.0
+    for i in range(arr.shape[0]):
+        s0 += arr[i, 0]
+        s1 += arr[i, 1]
+        s2 += arr[i, 2]
+    return s0, s1, s2
+
+@functools.lru_cache(maxsize=1)
+def _jit_sum3() -> Optional[Callable[[Sequence[Tuple[float, float, float]]], Tuple[float, float, float]]]:
+    """
+    Kernel numba sumujący (net, vat, gross). numpy/numba importujemy dopiero przy
+    pierwszej fakturze z >= NUMBA_MIN_ITEMS pozycjami, a nie przy imporcie modułu.
+    None, gdy któregoś z pakietów brak – wtedy liczymy w czystym Pythonie.
+    """
+    try:
+        import numpy as np
+        from numba import njit
+    except Exception:
+        return None
 
-    items = data.get("line_items", []) or []
-    net_sum = sum(float(i.get("net", 0) or 0) for i in items)
-    vat_sum = sum(float(i.get("vat", 0) or 0) for i in items)
-    gross_sum = sum(float(i.get("gross", 0) or 0) for i in items)
+    kernel = njit(cache=True)(_sum3_py)
+
+    def sum3(rows):
+        return kernel(np.asarray(rows, dtype=np.float64).reshape(len(rows), 3))
+
+    return sum3
+
+def _mismatch(label: str, sum_g: int, total_g: int) -> str:
+    return f"Mismatch {label}: {sum_g / SCALE:.2f} vs {total_g / SCALE:.2f}"
+
+def validate_totals_fast(total_net: float, total_vat: float, total_gross: float,
+                         rows: Sequence[Tuple[float, float, float]],
+                         tol: float = 0.01, fast: bool = False) -> Tuple[bool, List[str]]:
+    """
+    Walidacja sum dla gotowych floatów: rows to krotki (net, vat, gross).
+    fast=True – kończy na pierwszej niezgodności (zwraca tylko ten jeden błąd).
+    """
+    if not rows:
+        # brak pozycji = nie ma czego porównać (jak w validate_google_sheet)
+        return True, []
+
+    tol_g = round(tol * SCALE)
+    totals_g = (round(total_net * SCALE), round(total_vat * SCALE), round(total_gross * SCALE))
+    sum3 = _jit_sum3() if len(rows) >= NUMBA_MIN_ITEMS else None
+    if fast and sum3 is None:
+        # kolumna po kolumnie – przy niezgodności netto pozostałe nie są liczone
+        for k, label in enumerate(("net", "vat", "gross")):
+            s = round(math.fsum(r[k] for r in rows) * SCALE)
+            if abs(s - totals_g[k]) > tol_g:
+                return False, [_mismatch(label, s, totals_g[k])]
+        return True, []
+
+    if sum3 is not None:
+        sums = sum3(rows)
+    else:
+        sums = [math.fsum(col) for col in zip(*rows)]
+    sums_g = [round(x * SCALE) for x in sums]
 
     errors: List[str] = []
-    if abs(net_sum - total_net) > tol:
-        errors.append(f"Mismatch net: {net_sum:.2f} vs {total_net:.2f}")
-    if abs(vat_sum - total_vat) > tol:
-        errors.append(f"Mismatch vat: {vat_sum:.2f} vs {total_vat:.2f}")
-    if abs(gross_sum - total_gross) > tol:
-        errors.append(f"Mismatch gross: {gross_sum:.2f} vs {total_gross:.2f}")
+    for label, s, total in zip(("net", "vat", "gross"), sums_g, totals_g):
+        if abs(s - total) > tol_g:
+            errors.append(_mismatch(label, s, total))
+            if fast:
+                # kernel liczy wszystkie trzy sumy naraz – ale kontrakt fast to jeden błąd
+                break
 
     return len(errors) == 0, errors
 
+def validate_invoice(inv: Invoice, tol: float = 0.01, fast: bool = False) -> Tuple[bool, List[str]]:
+    """
+    Walidacja sum prosto z atrybutów Invoice/LineItem – bez budowania dictów.
+    Brakujące kwoty (None) liczą się jako 0, tak jak w validate_totals.
+    """
+    return validate_totals_fast(
+        inv.total_net, inv.total_vat, inv.total_gross,
+        [(li.net or 0.0, li.vat or 0.0, li.gross or 0.0) for li in inv.line_items],
+        tol=tol, fast=fast,
+    )
+
+def validate_totals(data: Dict[str, Any], tol: float = 0.01, fast: bool = False) -> Tuple[bool, List[str]]:
+    total_net = float(data.get("total_net", 0) or 0)
+    total_vat = float(data.get("total_vat", 0) or 0)
+    total_gross = float(data.get("total_gross", 0) or 0)
+
+    rows: List[Tuple[float, float, float]] = []
+    rows_append, _float = rows.append, float
+    for i in data.get("line_items", []) or []:
+        get = i.get
+        rows_append((_float(get("net", 0) or 0), _float(get("vat", 0) or 0), _float(get("gross", 0) or 0)))
+
+    return validate_totals_fast(total_net, total_vat, total_gross, rows, tol=tol, fast=fast)
+
 # =============== DOKUMENTY – PLIKI ===============
 
 def find_new_files(folder: Path) -> List[Path]:
     folder.mkdir(parents=True, exist_ok=True)
-    files = [p for p in folder.iterdir() if p.is_file() and p.suffix.lower() in SUPPORTED_EXT]
-    return sorted(files)
+    # scandir: is_file() korzysta z d_type z getdents – bez osobnego stat per plik
+    names = []
+    with os.scandir(folder) as it:
+        for de in it:
+            if not de.is_file():
+                continue
+            name = de.name
+            dot = name.rfind(".")
+            if dot <= 0:
+                continue
+            ext = name[dot:]
+            if ext in SUPPORTED_EXT or ext.lower() in SUPPORTED_EXT:
+                names.append(name)
+    # sortujemy same nazwy w miejscu (ta sama kolejność co sorted() po Path
+    # w jednym katalogu), Path budujemy dopiero na końcu
+    names.sort()
+    return [folder / n for n in names]
 
 def read_file_bytes(p: Path) -> bytes:
     return p.read_bytes()
 
 # =============== GOOGLE DOC AI – KLIENT (opcjonalnie) ===============
 
+@functools.lru_cache(maxsize=1)
 def _have_docai() -> bool:
     return bool(DOC_AI_PROJECT and DOC_AI_LOCATION and DOC_AI_PROCESSOR and GOOGLE_APPLICATION_CREDENTIALS_JSON)
 
-def _build_docai_client():
+def _have_docai_batch() -> bool:
+    return bool(_have_docai() and DOCAI_GCS_IN and DOCAI_GCS_OUT)
+
+@functools.lru_cache(maxsize=1)
+def _credentials_info() -> Dict[str, Any]:
+    """Sparsowany GOOGLE_APPLICATION_CREDENTIALS_JSON – parsowany raz na proces."""
+    return _loads(GOOGLE_APPLICATION_CREDENTIALS_JSON)
+
+def _service_account_credentials():
     """
-    Tworzy klienta Document AI z JSON-a trzymanego w sekrecie
-    GOOGLE_APPLICATION_CREDENTIALS_JSON (bez zapisywania pliku na dysk).
+    Credentials z JSON-a trzymanego w sekrecie GOOGLE_APPLICATION_CREDENTIALS_JSON
+    (bez zapisywania pliku na dysk).
     """
     from google.oauth2 import service_account
-    from google.api_core.client_options import ClientOptions
-    from google.cloud import documentai
 
-    info = json.loads(GOOGLE_APPLICATION_CREDENTIALS_JSON)
+    info = dict(_credentials_info())  # kopia – nie ruszamy wersji z cache
     # Uwaga: jeżeli chcesz rozliczać w konkretnym projekcie rozliczeniowym, możesz
     # wstawić "quota_project_id" = DOC_AI_PROJECT (o ile to poprawny billing project).
     if "quota_project_id" not in info and DOC_AI_PROJECT:
         info["quota_project_id"] = DOC_AI_PROJECT
 
-    creds = service_account.Credentials.from_service_account_info(
+    return service_account.Credentials.from_service_account_info(
         info,
         scopes=[
             "https://www.googleapis.com/auth/cloud-platform",
         ],
     )
 
+def _build_docai_client():
+    """Tworzy klienta Document AI dla regionu DOC_AI_LOCATION."""
+    from google.api_core.client_options import ClientOptions
+    from google.cloud import documentai
+
     endpoint = f"{DOC_AI_LOCATION}-documentai.googleapis.com"
     client = documentai.DocumentProcessorServiceClient(
         client_options=ClientOptions(api_endpoint=endpoint),
-        credentials=creds,
+        credentials=_service_account_credentials(),
     )
     return client
 
+@functools.lru_cache(maxsize=1)
+def _docai_client_cached():
+    """
+    (klient, processor_path) – budowane raz na proces i współdzielone przez
+    wszystkie pliki/wątki (klient gRPC jest thread-safe).
+    """
+    client = _build_docai_client()
+    return client, client.processor_path(DOC_AI_PROJECT, DOC_AI_LOCATION, DOC_AI_PROCESSOR)
+
 # =============== PARSING FAKTURY: DOC AI lub STUB ===============
 
-def parse_invoice_docai(file_path: Path) -> Optional[Invoice]:
+def parse_invoice_docai(file_path: Path, client=None, name: Optional[str] = None) -> Optional[Invoice]:
     """
     Parsuje fakturę przy pomocy Document AI (Invoice Parser).
     Zwraca Invoice albo None (w razie błędu).
+    Bez podanego client/name używa klienta z _docai_client_cached().
     """
     try:
         from google.cloud import documentai
@@ -167,8 +339,8 @@ def parse_invoice_docai(file_path: Path) -> Optional[Invoice]:
         return None
 
     try:
-        client = _build_docai_client()
-        name = client.processor_path(DOC_AI_PROJECT, DOC_AI_LOCATION, DOC_AI_PROCESSOR)
+        if client is None or name is None:
+            client, name = _docai_client_cached()
 
         raw = read_file_bytes(file_path)
         # Uwaga: Document AI łyka PDF, TIFF, oraz pojedyncze obrazy (JPEG/PNG).
@@ -183,49 +355,171 @@ def parse_invoice_docai(file_path: Path) -> Optional[Invoice]:
         }
 
         result = client.process_document(request=request)
-        doc = result.document
-
-        # Proste wyciąganie danych
-        number = _docai_find_first_text(doc, ["invoice_id", "invoice_number"]) or f"INV-{file_path.stem}"
-        issue_date = (_docai_find_first_text(doc, ["invoice_date", "issue_date"]) or
-                      datetime.now().date().isoformat())
-        seller = _docai_find_first_text(doc, ["supplier_name", "seller", "supplier"])
-        buyer = _docai_find_first_text(doc, ["customer_name", "buyer", "customer"])
-        currency = _docai_find_first_text(doc, ["currency"]) or "PLN"
-
-        # Suma
-        total_net = _docai_find_first_money(doc, ["net_amount", "subtotal_amount"]) or 0.0
-        total_vat = _docai_find_first_money(doc, ["total_tax_amount", "tax_amount"]) or 0.0
-        total_gross = _docai_find_first_money(doc, ["total_amount"]) or (
-            total_net + total_vat if (total_net or total_vat) else 0.0
-        )
+        return _invoice_from_docai_doc(result.document, file_path)
+    except Exception as e:
+        # traceback tylko przy DEBUG – w produkcji nie formatujemy go per plik
+        log.error("DocAI parsing failed for %s: %s", file_path.name, e,
+                  exc_info=log.isEnabledFor(logging.DEBUG))
+        return None
 
-        # Pozycje – Document AI ma tabelę line_items
-        items = _docai_parse_line_items(doc, currency_hint=currency)
-        if not items:
-            # awaryjnie – choćby 1 pozycja z kwotami
-            items = [LineItem(description="(no-items)", quantity=1.0, unit_price=total_gross,
-                              net=total_net or total_gross, vat_rate=_guess_vat_rate(total_net, total_vat),
-                              vat=total_vat, gross=total_gross)]
-
-        inv = Invoice(
-            number=number,
-            issue_date=issue_date,
-            seller=seller or "",
-            buyer=buyer or "",
-            currency=currency or "PLN",
-            total_net=round(float(total_net), 2),
-            total_vat=round(float(total_vat), 2),
-            total_gross=round(float(total_gross), 2),
-            line_items=items,
+def _split_gcs_uri(uri: str) -> Tuple[str, str]:
+    """'gs://bucket/a/b' -> ('bucket', 'a/b')"""
+    bucket, _, prefix = uri[len("gs://"):].partition("/")
+    return bucket, prefix.strip("/")
+
+def parse_invoices_docai_batch(files: List[Path]) -> Dict[Path, Invoice]:
+    """
+    Wsadowe parsowanie przez batch_process_documents: pliki lecą do DOCAI_GCS_IN,
+    jedno zlecenie LRO przetwarza wszystkie naraz, wyniki (JSON) czytamy
+    z DOCAI_GCS_OUT. Zwraca tylko faktury, które się udało sparsować –
+    resztę run_once przepuszcza przez zwykłą ścieżkę per plik.
+    """
+    try:
+        from google.cloud import documentai
+        from google.cloud import storage
+    except Exception as e:
+        log.warning("Brak pakietów do trybu wsadowego DocAI (documentai/storage): %s", e)
+        return {}
+
+    out: Dict[Path, Invoice] = {}
+    gcs = None
+    uploaded: List[Any] = []
+    run_id = datetime.now().strftime("%Y%m%d%H%M%S%f")
+    out_uri = f"{DOCAI_GCS_OUT.rstrip('/')}/{run_id}"
+    try:
+        client, name = _docai_client_cached()
+        gcs = storage.Client(project=DOC_AI_PROJECT, credentials=_service_account_credentials())
+
+        in_bucket, in_prefix = _split_gcs_uri(DOCAI_GCS_IN)
+        bucket = gcs.bucket(in_bucket)
+        by_uri: Dict[str, Path] = {}
+        documents = []
+        for f in files:
+            blob_name = "/".join(p for p in (in_prefix, run_id, f.name) if p)
+            mime = _guess_mime(f.suffix.lower())
+            blob = bucket.blob(blob_name)
+            blob.upload_from_filename(str(f), content_type=mime)
+            uploaded.append(blob)
+            uri = f"gs://{in_bucket}/{blob_name}"
+            by_uri[uri] = f
+            documents.append(documentai.GcsDocument(gcs_uri=uri, mime_type=mime))
+
+        request = documentai.BatchProcessRequest(
+            name=name,
+            input_documents=documentai.BatchDocumentsInputConfig(
+                gcs_documents=documentai.GcsDocuments(documents=documents),
+            ),
+            document_output_config=documentai.DocumentOutputConfig(
+                gcs_output_config=documentai.DocumentOutputConfig.GcsOutputConfig(
+                    gcs_uri=out_uri,
+                ),
+            ),
         )
-        return inv
+        operation = client.batch_process_documents(request=request)
+        log.info("DocAI batch: %d plików, czekam na %s", len(files), operation.operation.name)
+        try:
+            operation.result(timeout=DOCAI_BATCH_TIMEOUT_SEC)
+        except Exception:
+            # po timeoucie LRO dalej działa – anulujemy je, zanim finally usunie
+            # wejście; inaczej wyniki dojechałyby do GCS już po sprzątaniu
+            with contextlib.suppress(Exception):
+                if not operation.done():
+                    operation.cancel()
+            raise
+
+        metadata = documentai.BatchProcessMetadata(operation.metadata)
+        for status in metadata.individual_process_statuses:
+            f = by_uri.get(status.input_gcs_source)
+            if f is None:
+                continue
+            if status.status.code != 0:
+                log.warning("DocAI batch: %s nie przetworzony: %s", f.name, status.status.message)
+                continue
+            try:
+                out_bucket, out_prefix = _split_gcs_uri(status.output_gcs_destination)
+                # "/" na końcu – inaczej prefiks ".../1" łapie też ".../10/", ".../11/"
+                # duże dokumenty są dzielone na shardy – faktura mieści się w pierwszym
+                blobs = sorted((b for b in gcs.list_blobs(out_bucket, prefix=out_prefix + "/")
+                                if b.name.endswith(".json")), key=lambda b: b.name)
+                if not blobs:
+                    continue
+                doc = documentai.Document.from_json(blobs[0].download_as_bytes(), ignore_unknown_fields=True)
+                inv = _invoice_from_docai_doc(doc, f)
+                log.info("DocAI batch OK: %s → %s, %s PLN", f.name, inv.number, inv.total_gross)
+                out[f] = inv
+            except Exception as e:
+                log.error("DocAI batch: nie udało się odczytać wyniku dla %s: %s", f.name, e,
+                          exc_info=log.isEnabledFor(logging.DEBUG))
     except Exception as e:
-        log.exception("DocAI parsing failed for %s: %s", file_path.name, e)
-        return None
+        log.error("DocAI batch nie powiódł się: %s", e, exc_info=log.isEnabledFor(logging.DEBUG))
+    finally:
+        # pliki z inboxu nie znikają, więc każdy przebieg wrzuca je od nowa pod
+        # nowym run_id – sprzątamy wejście i wyniki, inaczej bucket rośnie bez końca
+        if gcs is not None:
+            _docai_batch_cleanup(gcs, uploaded, out_uri)
+    return out
 
-def parse_invoice_stub(file_path: Path) -> Invoice:
+def _docai_batch_cleanup(gcs, uploaded: List[Any], out_uri: str) -> None:
+    """Usuwa wgrane pliki wejściowe i cały prefiks wyników danego run_id."""
+    blobs = list(uploaded)
+    try:
+        out_bucket, out_prefix = _split_gcs_uri(out_uri)
+        blobs.extend(gcs.list_blobs(out_bucket, prefix=out_prefix + "/"))
+    except Exception as e:
+        log.warning("DocAI batch: nie udało się wylistować wyników %s: %s", out_uri, e)
+    for blob in blobs:
+        try:
+            blob.delete()
+        except Exception as e:
+            log.warning("DocAI batch: nie udało się usunąć %s: %s", blob.name, e)
+
+def _invoice_from_docai_doc(doc, file_path: Path) -> Invoice:
+    """Mapuje documentai.Document (z process_document albo z batcha) na Invoice."""
+    # Proste wyciąganie danych – encje indeksujemy raz na dokument
+    idx = _index_entities(getattr(doc, "entities", None))
+    number = _docai_find_first_text(idx, ["invoice_id", "invoice_number"]) or f"INV-{file_path.stem}"
+    issue_date = (_docai_find_first_text(idx, ["invoice_date", "issue_date"]) or
+                  datetime.now().date().isoformat())
+    seller = _docai_find_first_text(idx, ["supplier_name", "seller", "supplier"])
+    buyer = _docai_find_first_text(idx, ["customer_name", "buyer", "customer"])
+    currency = _docai_find_first_text(idx, ["currency"]) or "PLN"
+
+    # Suma
+    total_net = _docai_find_first_money(idx, ["net_amount", "subtotal_amount"]) or 0.0
+    total_vat = _docai_find_first_money(idx, ["total_tax_amount", "tax_amount"]) or 0.0
+    total_gross = _docai_find_first_money(idx, ["total_amount"]) or (
+        total_net + total_vat if (total_net or total_vat) else 0.0
+    )
+
+    # Pozycje – Document AI ma tabelę line_items
+    items = _docai_parse_line_items(doc, currency_hint=currency, idx=idx)
+    if not items:
+        # awaryjnie – choćby 1 pozycja z kwotami
+        items = [LineItem(description="(no-items)", quantity=1.0, unit_price=total_gross,
+                          net=total_net or total_gross, vat_rate=_guess_vat_rate(total_net, total_vat),
+                          vat=total_vat, gross=total_gross)]
+
+    inv = Invoice(
+        number=number,
+        issue_date=issue_date,
+        seller=seller or "",
+        buyer=buyer or "",
+        currency=currency or "PLN",
+        total_net=round(float(total_net), 2),
+        total_vat=round(float(total_vat), 2),
+        total_gross=round(float(total_gross), 2),
+        line_items=items,
+    )
+    return inv
+
+@functools.lru_cache(maxsize=1)
+def _now_strings(now: datetime) -> Tuple[str, str]:
+    """(znacznik do numeru faktury, data ISO) – formatowane raz na przebieg."""
+    return now.strftime("%Y%m%d%H%M%S"), now.date().isoformat()
+
+def parse_invoice_stub(file_path: Path, now: Optional[datetime] = None) -> Invoice:
     """Fallback – sztuczne dane, żeby przepływ był stabilny."""
+    stamp, today = _now_strings(now or datetime.now())
     items = [
         LineItem(description=f"Pozycja 1 z {file_path.name}", quantity=1.0, unit_price=100.0,
                  net=100.0, vat_rate=23.0, vat=23.0, gross=123.0),
@@ -237,8 +531,8 @@ def parse_invoice_stub(file_path: Path) -> Invoice:
     total_gross = sum(i.gross for i in items)
 
     return Invoice(
-        number=f"INV-{file_path.stem}-{datetime.now().strftime('%Y%m%d%H%M%S')}",
-        issue_date=datetime.now().date().isoformat(),
+        number=f"INV-{file_path.stem}-{stamp}",
+        issue_date=today,
         seller="Acme Sp. z o.o.",
         buyer="Twoja Firma Sp. z o.o.",
         currency="PLN",
@@ -246,28 +540,42 @@ def parse_invoice_stub(file_path: Path) -> Invoice:
         total_vat=total_vat,
         total_gross=total_gross,
         line_items=items,
+        is_stub=True,
     )
 
+_MIME: Dict[str, str] = {
+    ".pdf": "application/pdf",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+}
+
 def _guess_mime(ext: str) -> str:
-    if ext == ".pdf": return "application/pdf"
-    if ext in {".jpg", ".jpeg"}: return "image/jpeg"
-    if ext == ".png": return "image/png"
-    return "application/octet-stream"
-
-def _docai_find_first_text(doc, field_names: List[str]) -> Optional[str]:
-    # Entity extraction – Document AI klasyfikuje pola jako entities
-    for ent in getattr(doc, "entities", []) or []:
-        n = (ent.type_ or "").lower()
-        if n in (fn.lower() for fn in field_names):
+    return _MIME.get(ext, "application/octet-stream")
+
+def _index_entities(entities) -> Dict[str, List[Any]]:
+    """
+    type_ (małymi literami) -> encje w kolejności z dokumentu. Jedno przejście
+    po encjach zamiast pełnego skanu przy każdym szukanym polu.
+    """
+    idx: Dict[str, List[Any]] = {}
+    for ent in entities or []:
+        idx.setdefault((ent.type_ or "").lower(), []).append(ent)
+    return idx
+
+def _docai_find_first_text(idx: Dict[str, List[Any]], field_names: Sequence[str]) -> Optional[str]:
+    # Entity extraction – Document AI klasyfikuje pola jako entities;
+    # field_names w kolejności priorytetu
+    for fn in field_names:
+        for ent in idx.get(fn.lower(), ()):
             val = (ent.mention_text or ent.normalized_value.text or "").strip()
             if val:
                 return val
     return None
 
-def _docai_find_first_money(doc, field_names: List[str]) -> Optional[float]:
-    for ent in getattr(doc, "entities", []) or []:
-        n = (ent.type_ or "").lower()
-        if n in (fn.lower() for fn in field_names):
+def _docai_find_first_money(idx: Dict[str, List[Any]], field_names: Sequence[str]) -> Optional[float]:
+    for fn in field_names:
+        for ent in idx.get(fn.lower(), ()):
             # money_value or normalized_value.{money_value}
             try:
                 if ent.normalized_value and ent.normalized_value.money_value:
@@ -277,49 +585,50 @@ def _docai_find_first_money(doc, field_names: List[str]) -> Optional[float]:
             except Exception:
                 pass
             # fallback – parsuj tekst
-            txt = (ent.mention_text or "").replace(",", ".")
-            try:
-                return float("".join(ch for ch in txt if (ch.isdigit() or ch in ".-")))
-            except Exception:
-                continue
+            val = _safe_money(ent.mention_text)
+            if val is not None:
+                return val
     return None
 
-def _docai_parse_line_items(doc, currency_hint: str = "PLN") -> List[LineItem]:
+def _docai_parse_line_items(doc, currency_hint: str = "PLN",
+                            idx: Optional[Dict[str, List[Any]]] = None) -> List[LineItem]:
     """Próba wyciągnięcia pozycji z entities/tables. Minimalny, bezpieczny parser."""
     out: List[LineItem] = []
+    out_append = out.append
+    if idx is None:
+        idx = _index_entities(getattr(doc, "entities", None))
     # 1) Spróbuj line_item entities:
-    for ent in getattr(doc, "entities", []) or []:
-        if (ent.type_ or "").lower() in {"line_item", "lineItem", "lineitem"}:
-            desc = _entity_child_text(ent, {"description", "item_description"}) or (ent.mention_text or "").strip()
-            qty = _entity_child_float(ent, {"quantity", "qty"}) or 1.0
-            unit_price = _entity_child_money(ent, {"unit_price", "unit_price_amount"}) or 0.0
-            net = _entity_child_money(ent, {"net_amount", "subtotal_amount"}) or (qty * unit_price)
-            vat = _entity_child_money(ent, {"tax_amount"}) or 0.0
-            gross = _entity_child_money(ent, {"amount", "total_amount"}) or (net + vat)
-            vat_rate = _guess_vat_rate(net, vat)
-            out.append(LineItem(
-                description=desc or "(line item)",
-                quantity=float(qty),
-                unit_price=float(unit_price),
-                net=float(net),
-                vat_rate=float(vat_rate),
-                vat=float(vat),
-                gross=float(gross),
-            ))
+    for ent in idx.get("line_item", []) + idx.get("lineitem", []):
+        props = _index_entities(getattr(ent, "properties", None))
+        desc = _entity_child_text(props, ("description", "item_description")) or (ent.mention_text or "").strip()
+        qty = _entity_child_float(props, ("quantity", "qty")) or 1.0
+        unit_price = _entity_child_money(props, ("unit_price", "unit_price_amount")) or 0.0
+        net = _entity_child_money(props, ("net_amount", "subtotal_amount")) or (qty * unit_price)
+        vat = _entity_child_money(props, ("tax_amount",)) or 0.0
+        gross = _entity_child_money(props, ("amount", "total_amount")) or (net + vat)
+        vat_rate = _guess_vat_rate(net, vat)
+        out_append(LineItem(
+            description=desc or "(line item)",
+            quantity=float(qty),
+            unit_price=float(unit_price),
+            net=float(net),
+            vat_rate=float(vat_rate),
+            vat=float(vat),
+            gross=float(gross),
+        ))
 
     if out:
         return out
 
     # 2) Awaryjnie: spróbuj z tabel
     # (pełny parser tabel to kilka-kilkanaście ekranów – tutaj minimalny fallback)
+    text = getattr(doc, "text", "") or ""
     for page in getattr(doc, "pages", []) or []:
         for table in getattr(page, "tables", []) or []:
             try:
-                headers = ["".join(_layout_text(doc, cell.layout) for cell in row.cells).lower()
-                           for row in table.header_rows]
                 # poszukaj pierwszego wiersza danych
                 for row in table.body_rows:
-                    texts = ["".join(_layout_text(doc, cell.layout) for cell in row.cells) for cell in row.cells]
+                    texts = [_layout_text(text, cell.layout) for cell in row.cells]
                     if not texts:
                         continue
                     # heurystyka: opis + kwoty
@@ -331,9 +640,10 @@ def _docai_parse_line_items(doc, currency_hint: str = "PLN") -> List[LineItem]:
                     qty = nums[0] or 1.0
                     unit_price = (nums[1] if len(nums) > 1 else None) or 0.0
                     net = (nums[2] if len(nums) > 2 else None) or (qty * unit_price)
-                    vat = (nums[3] if len(nums) > 3 else 0.0)
-                    gross = (nums[4] if len(nums) > 4 else (net + vat))
-                    out.append(LineItem(
+                    # nieczytelna komórka -> None; do LineItem idą wyłącznie liczby
+                    vat = (nums[3] if len(nums) > 3 else None) or 0.0
+                    gross = nums[4] if len(nums) > 4 and nums[4] is not None else (net + vat)
+                    out_append(LineItem(
                         description=desc, quantity=qty, unit_price=unit_price,
                         net=net, vat_rate=_guess_vat_rate(net, vat), vat=vat, gross=gross
                     ))
@@ -341,39 +651,34 @@ def _docai_parse_line_items(doc, currency_hint: str = "PLN") -> List[LineItem]:
                 continue
     return out
 
-def _entity_child_text(ent, names: set) -> Optional[str]:
-    for prop in getattr(ent, "properties", []) or []:
-        if (prop.type_ or "").lower() in {n.lower() for n in names}:
+def _entity_child_text(props: Dict[str, List[Any]], names: Sequence[str]) -> Optional[str]:
+    # props – _index_entities(ent.properties), budowany raz na pozycję
+    for n in names:
+        for prop in props.get(n.lower(), ()):
             txt = (prop.mention_text or prop.normalized_value.text or "").strip()
             if txt:
                 return txt
     return None
 
-def _entity_child_float(ent, names: set) -> Optional[float]:
-    t = _entity_child_text(ent, names)
+def _entity_child_float(props: Dict[str, List[Any]], names: Sequence[str]) -> Optional[float]:
+    t = _entity_child_text(props, names)
     if t is None:
         return None
-    t = t.replace(",", ".")
-    try:
-        return float("".join(ch for ch in t if (ch.isdigit() or ch in ".-")))
-    except Exception:
-        return None
+    return _safe_money(t)
 
-def _entity_child_money(ent, names: set) -> Optional[float]:
+def _entity_child_money(props: Dict[str, List[Any]], names: Sequence[str]) -> Optional[float]:
     # money z normalized_value ma units/nanos
-    for prop in getattr(ent, "properties", []) or []:
-        if (prop.type_ or "").lower() in {n.lower() for n in names}:
+    for n in names:
+        for prop in props.get(n.lower(), ()):
             try:
                 if prop.normalized_value and prop.normalized_value.money_value:
                     mv = prop.normalized_value.money_value
                     return float((mv.units or 0) + (mv.nanos or 0) / 1e9)
             except Exception:
                 pass
-            txt = (prop.mention_text or "").replace(",", ".")
-            try:
-                return float("".join(ch for ch in txt if (ch.isdigit() or ch in ".-")))
-            except Exception:
-                continue
+            val = _safe_money(prop.mention_text)
+            if val is not None:
+                return val
     return None
 
 def _guess_vat_rate(net: float, vat: float) -> float:
@@ -389,67 +694,304 @@ def _guess_vat_rate(net: float, vat: float) -> float:
         pass
     return 0.0
 
-def _layout_text(doc, layout) -> str:
-    # łączy tokeny wg segmentów – minimalny ekstraktor
+def _layout_text(text: str, layout) -> str:
+    # łączy tokeny wg segmentów – minimalny ekstraktor; text = doc.text
+    anchor = getattr(layout, "text_anchor", None)
     out = []
-    for seg in getattr(layout, "text_anchor", {}).get("text_segments", []) or []:
+    for seg in getattr(anchor, "text_segments", None) or []:
         start = int(seg.start_index or 0)
         end = int(seg.end_index or 0)
-        out.append((doc.text or "")[start:end])
+        out.append(text[start:end])
     return "".join(out)
 
-def _safe_money(s: str) -> Optional[float]:
+# wszystko poza cyframi, kropką i minusem – wycinane jednym sub() w C
+_MONEY_JUNK_RE = re.compile(r"[^0-9.\-]")
+
+def _safe_money(s: Optional[str]) -> Optional[float]:
+    """'1 234,56 zł' -> 1234.56; None, gdy po oczyszczeniu nie ma liczby."""
     try:
-        s = (s or "").replace(",", ".")
-        return float("".join(ch for ch in s if (ch.isdigit() or ch in ".-")))
-    except Exception:
+        return float(_MONEY_JUNK_RE.sub("", (s or "").replace(",", ".")))
+    except ValueError:
         return None
 
 # =============== ZAPIS DO EXCEL ===============
+# Zapis jest strumieniowy: run_once otwiera "sink" raz na przebieg i oddaje mu
+# faktury jedna po drugiej, więc cała partia nie siedzi w pamięci.
+# Przebieg bez żadnej faktury nie nadpisuje istniejącego pliku.
+
+HEADERS_DANE = ("number", "issue_date", "seller", "buyer", "currency", "total_net", "total_vat", "total_gross")
+HEADERS_POZYCJE = ("invoice_number", "description", "quantity", "unit_price", "net", "vat_rate", "vat", "gross")
+HEADERS_KOSZTY = ("invoice_number", "category", "amount", "note")
+
+def _dane_row(inv: Invoice) -> tuple:
+    return (inv.number, inv.issue_date, inv.seller, inv.buyer, inv.currency,
+            inv.total_net, inv.total_vat, inv.total_gross)
+
+def _pozycje_rows(inv: Invoice) -> List[tuple]:
+    number = inv.number
+    return [(number, li.description, li.quantity, li.unit_price, li.net, li.vat_rate, li.vat, li.gross)
+            for li in inv.line_items]
 
+# litery kolumn A..Z liczone raz – arkusze mają najwyżej 8 kolumn
+COL_LETTERS = [chr(c) for c in range(ord("A"), ord("Z") + 1)]
+
+def _set_uniform_width(ws, ncols: int, width: float = 18) -> None:
+    for i in range(ncols):
+        ws.column_dimensions[COL_LETTERS[i]].width = width
+
+@functools.lru_cache(maxsize=1)
 def ensure_openpyxl():
+    """
+    Zwraca openpyxl.Workbook. Import dopiero przy pierwszym ExcelSink – domyślny
+    silnik "raw" w ogóle nie potrzebuje openpyxl (ani numpy, które on ciągnie).
+    """
     try:
-        import openpyxl  # noqa: F401
+        from openpyxl import Workbook
     except Exception as e:
         raise RuntimeError("Brak pakietu 'openpyxl'. Zainstaluj: pip install openpyxl") from e
+    return Workbook
+
+class ExcelSink:
+    """
+    Zapis przez openpyxl w trybie write_only – wiersze są strumieniowane do XML
+    (lxml, jeśli jest dostępny) zamiast budować całą siatkę komórek w pamięci.
+    """
+
+    def __init__(self, out_path: Path):
+        self.out_path = out_path
+        self.count = 0
+
+    def __enter__(self) -> "ExcelSink":
+        self.wb = ensure_openpyxl()(write_only=True)
+        self.ws1 = self.wb.create_sheet("Dane")
+        self.ws2 = self.wb.create_sheet("Pozycje")
+        self.ws3 = self.wb.create_sheet("Koszty_surowcow")
+
+        # write_only: szerokości kolumn trzeba ustawić przed pierwszym append()
+        for ws, headers in ((self.ws1, HEADERS_DANE), (self.ws2, HEADERS_POZYCJE), (self.ws3, HEADERS_KOSZTY)):
+            _set_uniform_width(ws, len(headers))
+            ws.append(headers)
+        return self
+
+    def write(self, inv: Invoice) -> None:
+        self.ws1.append(_dane_row(inv))
+        for row in _pozycje_rows(inv):
+            self.ws2.append(row)
+        self.count += 1
+
+    def discard(self) -> None:
+        """Nie zapisuj pliku przy zamknięciu."""
+        self.count = 0
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None and self.count:
+            self.out_path.parent.mkdir(parents=True, exist_ok=True)
+            self.wb.save(str(self.out_path))  # save() sam sprząta pliki tymczasowe arkuszy
+            log.info("Zapisano Excel: %s", self.out_path)
+        else:
+            self._cleanup()
+
+    def _cleanup(self) -> None:
+        # write_only trzyma każdy arkusz w NamedTemporaryFile(delete=False);
+        # bez save() zostałyby do końca procesu – zamykamy i usuwamy je tak
+        # jak robi to ExcelWriter.write_worksheet
+        for ws in (self.ws1, self.ws2, self.ws3):
+            with contextlib.suppress(Exception):
+                if not ws.closed:
+                    ws.close()
+                ws._writer.cleanup()
 
 def write_to_excel(invoices: List[Invoice], out_xlsx: Path) -> None:
-    ensure_openpyxl()
-    from openpyxl import Workbook
-    from openpyxl.utils import get_column_letter
-
-    wb = Workbook()
-    ws1 = wb.active
-    ws1.title = "Dane"
-    headers1 = ["number", "issue_date", "seller", "buyer", "currency", "total_net", "total_vat", "total_gross"]
-    ws1.append(headers1)
-    for inv in invoices:
-        ws1.append([inv.number, inv.issue_date, inv.seller, inv.buyer, inv.currency,
-                    inv.total_net, inv.total_vat, inv.total_gross])
-
-    ws2 = wb.create_sheet("Pozycje")
-    headers2 = ["invoice_number", "description", "quantity", "unit_price", "net", "vat_rate", "vat", "gross"]
-    ws2.append(headers2)
-    for inv in invoices:
-        for li in inv.line_items:
-            ws2.append([inv.number, li.description, li.quantity, li.unit_price, li.net, li.vat_rate, li.vat, li.gross])
+    with ExcelSink(out_xlsx) as sink:
+        for inv in invoices:
+            sink.write(inv)
+
+# =============== ZAPIS DO EXCEL – BEZPOŚREDNI ZIP+XML ===============
+# Arkusze mają stały, prosty układ (bez stylów i formuł), więc XLSX składamy
+# sami: to tylko ZIP z kilkoma plikami XML. Tekst idzie jako inlineStr, żeby
+# nie budować tabeli sharedStrings.
+
+_XLSX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '{sheets}'
+    '</Types>'
+)
+_XLSX_CONTENT_TYPE_SHEET = (
+    '<Override PartName="/xl/worksheets/sheet{n}.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+)
+_XLSX_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+_XLSX_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets>{sheets}</sheets>'
+    '</workbook>'
+)
+_XLSX_WORKBOOK_SHEET = '<sheet name="{name}" sheetId="{n}" r:id="rId{n}"/>'
+_XLSX_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '{sheets}'
+    '<Relationship Id="rId{styles_id}" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+    'Target="styles.xml"/>'
+    '</Relationships>'
+)
+_XLSX_WORKBOOK_RELS_SHEET = (
+    '<Relationship Id="rId{n}" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet{n}.xml"/>'
+)
+_XLSX_STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+    '<fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+)
+_XLSX_SHEET_HEAD = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<cols><col min="1" max="{ncols}" width="18" customWidth="1"/></cols>'
+    '<sheetData>'
+)
+_XLSX_SHEET_TAIL = '</sheetData></worksheet>'
+
+# znaki sterujące niedozwolone w XML 1.0 (ten sam zakres co ILLEGAL_CHARACTERS_RE
+# w openpyxl) – OCR potrafi je zwrócić, a jeden taki znak psuje cały arkusz
+_XML_ILLEGAL_RE = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+def _xlsx_row(r: int, values) -> str:
+    cells = []
+    for v in values:
+        if v is None:
+            cells.append("<c/>")
+        elif isinstance(v, str):
+            v = xml_escape(_XML_ILLEGAL_RE.sub("", v))
+            cells.append(f'<c t="inlineStr"><is><t xml:space="preserve">{v}</t></is></c>')
+        else:
+            cells.append(f"<c><v>{v!r}</v></c>")
+    return f'<row r="{r}">{"".join(cells)}</row>'
 
-    ws3 = wb.create_sheet("Koszty_surowcow")
-    ws3.append(["invoice_number", "category", "amount", "note"])
 
-    for ws in (ws1, ws2, ws3):
-        for col_idx, _ in enumerate(ws.iter_cols(min_row=1, max_row=1), start=1):
-            ws.column_dimensions[get_column_letter(col_idx)].width = 18
+class RawExcelSink:
+    """
+    Zapis XLSX bez openpyxl – te same 3 arkusze co ExcelSink. Wiersze Dane/Pozycje
+    lecą od razu do plików tymczasowych, a ZIP jest składany przy zamknięciu.
+    """
 
-    out_xlsx.parent.mkdir(parents=True, exist_ok=True)
-    wb.save(str(out_xlsx))
-    log.info("Zapisano Excel: %s", out_xlsx)
+    def __init__(self, out_path: Path):
+        self.out_path = out_path
+        self.count = 0
+
+    def __enter__(self) -> "RawExcelSink":
+        self._dane = tempfile.TemporaryFile()
+        self._poz = tempfile.TemporaryFile()
+        self._dane_r = self._poz_r = 1  # wiersz 1 to nagłówki
+        return self
+
+    def write(self, inv: Invoice) -> None:
+        self._dane_r += 1
+        self._dane.write(_xlsx_row(self._dane_r, _dane_row(inv)).encode("utf-8"))
+        chunks = []
+        for row in _pozycje_rows(inv):
+            self._poz_r += 1
+            chunks.append(_xlsx_row(self._poz_r, row))
+        self._poz.write("".join(chunks).encode("utf-8"))
+        self.count += 1
+
+    def discard(self) -> None:
+        """Nie składaj ZIP-a przy zamknięciu."""
+        self.count = 0
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        try:
+            if exc_type is None and self.count:
+                self._save()
+        finally:
+            self._dane.close()
+            self._poz.close()
+
+    def _save(self) -> None:
+        sheets = (
+            ("Dane", HEADERS_DANE, self._dane),
+            ("Pozycje", HEADERS_POZYCJE, self._poz),
+            ("Koszty_surowcow", HEADERS_KOSZTY, None),
+        )
+        nums = range(1, len(sheets) + 1)
+
+        # ZIP składamy obok docelowego pliku i podmieniamy atomowo – przerwany
+        # zapis nie zostawia połówki w miejscu ostatniego dobrego OUT_XLSX
+        self.out_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(prefix=".tmp-", suffix=".xlsx", dir=self.out_path.parent)
+        try:
+            with os.fdopen(fd, "wb") as raw:
+                self._write_zip(raw, sheets, nums)
+            # mkstemp daje 0600 – zachowaj uprawnienia poprzedniego pliku
+            try:
+                shutil.copymode(self.out_path, tmp_name)
+            except FileNotFoundError:
+                os.chmod(tmp_name, 0o644)
+            os.replace(tmp_name, self.out_path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp_name)
+            raise
+
+        log.info("Zapisano Excel: %s", self.out_path)
+
+    @staticmethod
+    def _write_zip(raw, sheets, nums) -> None:
+        with zipfile.ZipFile(raw, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+            zf.writestr("[Content_Types].xml", _XLSX_CONTENT_TYPES.format(
+                sheets="".join(_XLSX_CONTENT_TYPE_SHEET.format(n=n) for n in nums)))
+            zf.writestr("_rels/.rels", _XLSX_ROOT_RELS)
+            zf.writestr("xl/workbook.xml", _XLSX_WORKBOOK.format(
+                sheets="".join(_XLSX_WORKBOOK_SHEET.format(name=name, n=n) for n, (name, _, _) in zip(nums, sheets))))
+            zf.writestr("xl/_rels/workbook.xml.rels", _XLSX_WORKBOOK_RELS.format(
+                sheets="".join(_XLSX_WORKBOOK_RELS_SHEET.format(n=n) for n in nums), styles_id=len(sheets) + 1))
+            zf.writestr("xl/styles.xml", _XLSX_STYLES)
+
+            for n, (_, headers, body) in zip(nums, sheets):
+                with zf.open(f"xl/worksheets/sheet{n}.xml", "w") as fh:
+                    fh.write(_XLSX_SHEET_HEAD.format(ncols=len(headers)).encode("utf-8"))
+                    fh.write(_xlsx_row(1, headers).encode("utf-8"))
+                    if body is not None:
+                        body.seek(0)
+                        shutil.copyfileobj(body, fh)
+                    fh.write(_XLSX_SHEET_TAIL.encode("utf-8"))
+
+def write_to_excel_raw(invoices: List[Invoice], out_xlsx: Path) -> None:
+    with RawExcelSink(out_xlsx) as sink:
+        for inv in invoices:
+            sink.write(inv)
 
 # =============== GŁÓWNY PRZEPŁYW ===============
 
-def process_one_file(file_path: Path) -> Optional[Invoice]:
+def process_one_file(file_path: Path, now: Optional[datetime] = None) -> Optional[Invoice]:
     """
     Jeśli jest Document AI -> użyj go; inaczej fallback do stubów.
+    `now` – wspólny znacznik czasu przebiegu (run_once), żeby nie czytać zegara per plik.
     """
     try:
         if _have_docai():
@@ -458,51 +1000,140 @@ def process_one_file(file_path: Path) -> Optional[Invoice]:
                 log.info("DocAI OK: %s → %s, %s PLN", file_path.name, inv.number, inv.total_gross)
                 return inv
             log.warning("DocAI zwrócił None, używam stubu dla %s", file_path.name)
-        inv = parse_invoice_stub(file_path)
+        inv = parse_invoice_stub(file_path, now=now)
         return inv
     except Exception as e:
-        log.exception("Błąd podczas przetwarzania %s: %s", file_path, e)
+        log.error("Błąd podczas przetwarzania %s: %s", file_path, e,
+                  exc_info=log.isEnabledFor(logging.DEBUG))
         return None
 
+# nazwy pól liczone raz – zamiast asdict() (rekurencja + deepcopy per pole)
+_LI_FIELDS: Tuple[str, ...] = tuple(f.name for f in fields(LineItem))
+
+def _li_to_dict(li: LineItem) -> Dict[str, Any]:
+    return {n: getattr(li, n) for n in _LI_FIELDS}
+
+class DryRunSink:
+    """DRY_RUN – zamiast zapisu XLSX tylko podgląd faktur w logu."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __enter__(self) -> "DryRunSink":
+        log.info("[DRY_RUN] Podgląd danych – zapis XLSX pominięty.")
+        return self
+
+    def write(self, inv: Invoice) -> None:
+        self.count += 1
+        if not log.isEnabledFor(logging.INFO):
+            return
+        log.info("HEADER: %s", _dumps(inv.as_header_row()))
+        for li in inv.line_items:
+            log.info("LINE: %s", _dumps(_li_to_dict(li)))
+
+    def discard(self) -> None:
+        pass
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+def _open_sink(out_xlsx: Path):
+    if DRY_RUN:
+        return DryRunSink()
+    if XLSX_ENGINE == "openpyxl":
+        return ExcelSink(out_xlsx)
+    return RawExcelSink(out_xlsx)
+
+# skrót zawartości ostatnio zapisanego XLSX – pozwala pominąć zapis, gdy
+# kolejny przebieg w run_loop dał dokładnie te same wiersze
+_last_hash: Optional[bytes] = None
+
+def _hash_invoice(h, inv: Invoice) -> None:
+    h.update(repr(_dane_row(inv)).encode("utf-8"))
+    for row in _pozycje_rows(inv):
+        h.update(repr(row).encode("utf-8"))
+
 def run_once() -> None:
-    files = find_new_files(INBOX_DIR)
+    global _last_hash
+
+    inbox = inbox_dir()
+    out_xlsx = out_xlsx_path()
+    files = find_new_files(inbox)
     if not files:
-        log.info("Brak plików w %s", INBOX_DIR)
+        log.info("Brak plików w %s", inbox)
         return
 
-    invoices: List[Invoice] = []
-    for f in files:
-        inv = process_one_file(f)
-        if inv:
-            ok, errs = validate_totals({
-                "total_net": inv.total_net,
-                "total_vat": inv.total_vat,
-                "total_gross": inv.total_gross,
-                "line_items": [asdict(li) for li in inv.line_items],
-            })
-            if not ok:
-                log.warning("Walidacja NIE przeszła dla %s: %s", f.name, errs)
-            invoices.append(inv)
-
-    if not invoices:
+    # DocAI to głównie czekanie na HTTP – wątki wystarczą; dla lokalnego,
+    # CPU-bound parsowania można przełączyć na procesy (PARSE_EXECUTOR=process).
+    # map() zachowuje kolejność plików, więc Excel jest deterministyczny;
+    # każdą gotową fakturę od razu oddajemy do sinka.
+    # Przy większej partii DocAI wsadowo (jedno LRO); czego batch nie zwrócił,
+    # idzie zwykłą ścieżką per plik.
+    batch: Dict[Path, Invoice] = {}
+    if len(files) >= DOCAI_BATCH_THRESHOLD and _have_docai_batch():
+        batch = parse_invoices_docai_batch(files)
+    rest = [f for f in files if f not in batch]
+
+    # Dla jednego pliku (albo PARSE_WORKERS<=1) pula nic nie daje – liczymy po kolei.
+    parse = functools.partial(process_one_file, now=datetime.now())
+    pool = None
+    if len(rest) > 1 and PARSE_WORKERS > 1:
+        executor_cls = ProcessPoolExecutor if PARSE_EXECUTOR == "process" else ThreadPoolExecutor
+        if _have_docai() and executor_cls is ThreadPoolExecutor:
+            # klienta budujemy raz, zanim wątki zaczną się o niego ścigać
+            try:
+                _docai_client_cached()
+            except Exception as e:
+                log.error("Nie udało się zbudować klienta DocAI: %s", e)
+        pool = executor_cls(max_workers=PARSE_WORKERS)
+
+    digest = hashlib.blake2b(digest_size=16)
+    with (pool or contextlib.nullcontext()), _open_sink(out_xlsx) as sink:
+        results = iter(pool.map(parse, rest) if pool else map(parse, rest))
+        for f in files:
+            inv = batch[f] if f in batch else next(results)
+            if not inv:
+                continue
+            if not inv.is_stub:
+                ok, errs = validate_invoice(inv, fast=True)
+                if not ok:
+                    log.warning("Walidacja NIE przeszła dla %s: %s", f.name, errs)
+            sink.write(inv)
+            _hash_invoice(digest, inv)
+
+        h = digest.digest()
+        if not DRY_RUN and sink.count and h == _last_hash and out_xlsx.exists():
+            log.info("Brak zmian względem poprzedniego zapisu – pomijam zapis XLSX.")
+            sink.discard()
+            return
+
+    if not sink.count:
         log.info("Brak danych do zapisu.")
-        return
+    elif not DRY_RUN:
+        _last_hash = h
 
-    if DRY_RUN:
-        log.info("[DRY_RUN] Podgląd danych – zapis XLSX pominięty.")
-        for inv in invoices:
-            log.info("HEADER: %s", json.dumps(inv.as_header_row(), ensure_ascii=False))
-            for li in inv.line_items:
-                log.info("LINE: %s", json.dumps(asdict(li), ensure_ascii=False))
-        return
+_stop = threading.Event()
 
-    write_to_excel(invoices, OUT_XLSX)
+def _request_stop(signum, frame) -> None:
+    log.info("Otrzymano sygnał %s – kończę pętlę.", signum)
+    _stop.set()
 
 def run_loop() -> None:
+    """
+    Stały rytm co LOOP_SLEEP_SEC liczony od startu przebiegu (time.monotonic),
+    a nie „przebieg + sleep”. Czekanie na Event można przerwać (_stop / SIGTERM).
+    """
     log.info("Start pętli – co %d s", LOOP_SLEEP_SEC)
-    while True:
+    next_tick = time.monotonic()
+    while not _stop.is_set():
         run_once()
-        time.sleep(LOOP_SLEEP_SEC)
+        next_tick += LOOP_SLEEP_SEC
+        delay = next_tick - time.monotonic()
+        if delay <= 0:
+            log.warning("Przebieg przekroczył LOOP_SLEEP_SEC o %.1f s", -delay)
+            next_tick = time.monotonic()
+            delay = 0.0
+        _stop.wait(delay)
 
 # =============== CLI ===============
 
@@ -514,12 +1145,13 @@ def parse_args(argv: List[str]) -> argparse.Namespace:
 def main(argv: List[str]) -> int:
     args = parse_args(argv)
     log.info("Konfig: INBOX_DIR=%s, OUT_XLSX=%s, DRY_RUN=%s, DOC_AI=%s",
-             INBOX_DIR, OUT_XLSX, DRY_RUN, _have_docai())
-    INBOX_DIR.mkdir(parents=True, exist_ok=True)
+             inbox_dir(), out_xlsx_path(), DRY_RUN, _have_docai())
+    inbox_dir().mkdir(parents=True, exist_ok=True)
     try:
         if args.once:
             run_once()
         else:
+            signal.signal(signal.SIGTERM, _request_stop)
             run_loop()
         return 0
     except KeyboardInterrupt:
@@ -0,0 +1,134 @@
+import json
+import sys
+import types
+from types import SimpleNamespace as NS
+
+import pytest
+
+import process_invoices as pi
+
+class _Msg:
+    def __init__(self, **kw): self.__dict__.update(kw)
+
+class _Blob:
+    def __init__(self, store, bucket, name):
+        self.store, self.bucket, self.name = store, bucket, name
+    def upload_from_filename(self, fn, content_type=None):
+        self.store[(self.bucket, self.name)] = open(fn, "rb").read()
+    def download_as_bytes(self):
+        return self.store[(self.bucket, self.name)]
+    def delete(self):
+        del self.store[(self.bucket, self.name)]
+
+class _Storage:
+    def __init__(self, store): self.store = store
+    def bucket(self, b): return NS(blob=lambda n: _Blob(self.store, b, n))
+    def list_blobs(self, b, prefix=""):
+        return [_Blob(self.store, bb, n) for bb, n in list(self.store) if bb == b and n.startswith(prefix)]
+
+class _Operation:
+    def __init__(self, statuses, timeout=False):
+        self.metadata, self.operation, self.timeout = statuses, NS(name="op/1"), timeout
+        self.cancelled = False
+    def result(self, timeout=None):
+        if self.timeout:
+            raise TimeoutError("Operation did not complete within the designated timeout.")
+    def done(self): return not self.timeout
+    def cancel(self): self.cancelled = True
+
+class _Client:
+    """
+    Wynik per plik wg prefiksu nazwy: 'x' – brak statusu, 'e' – status z błędem,
+    'n' – status OK, ale bez JSON-a; pozostałe – normalny wynik.
+    """
+    def __init__(self, store):
+        self.store, self.timeout, self.operations = store, False, []
+    def batch_process_documents(self, request):
+        out = request.document_output_config.gcs_output_config.gcs_uri
+        bucket, _, prefix = out[len("gs://"):].partition("/")
+        statuses = []
+        # kolejność statusów celowo odwrócona – mapowanie ma iść po URI
+        for i, d in reversed(list(enumerate(request.input_documents.gcs_documents.documents))):
+            name = d.gcs_uri.rsplit("/", 1)[1]
+            if name.startswith("x"):
+                continue
+            if name[0] not in "en":
+                self.store[(bucket, f"{prefix}/{i}/doc-0.json")] = json.dumps({"id": "B-" + name}).encode()
+            code = 3 if name.startswith("e") else 0
+            statuses.append(NS(input_gcs_source=d.gcs_uri, output_gcs_destination=f"{out}/{i}",
+                               status=NS(code=code, message="INVALID_ARGUMENT" if code else "")))
+        self.operations.append(_Operation(statuses, timeout=self.timeout))
+        return self.operations[-1]
+
+def _ent(t, txt):
+    return NS(type_=t, mention_text=txt, normalized_value=NS(text="", money_value=None), properties=[])
+
+@pytest.fixture
+def fake_gcloud(monkeypatch):
+    store = {}
+    documentai = types.ModuleType("google.cloud.documentai")
+    for n in ("GcsDocument", "GcsDocuments", "BatchDocumentsInputConfig", "BatchProcessRequest"):
+        setattr(documentai, n, type(n, (_Msg,), {}))
+    documentai.DocumentOutputConfig = type("DocumentOutputConfig", (_Msg,), {"GcsOutputConfig": _Msg})
+    documentai.BatchProcessMetadata = lambda m: NS(individual_process_statuses=m)
+    documentai.Document = NS(from_json=lambda b, ignore_unknown_fields=False: NS(
+        entities=[_ent("invoice_id", json.loads(b)["id"]), _ent("total_amount", "12,30")], pages=[], text=""))
+    storage = types.ModuleType("google.cloud.storage")
+    storage.Client = lambda project=None, credentials=None: _Storage(store)
+    cloud = types.ModuleType("google.cloud")
+    cloud.documentai, cloud.storage = documentai, storage
+    google = types.ModuleType("google")
+    google.cloud = cloud
+    for name, mod in (("google", google), ("google.cloud", cloud),
+                      ("google.cloud.documentai", documentai), ("google.cloud.storage", storage)):
+        monkeypatch.setitem(sys.modules, name, mod)
+
+    monkeypatch.setattr(pi, "DOCAI_GCS_IN", "gs://in-bucket/uploads")
+    monkeypatch.setattr(pi, "DOCAI_GCS_OUT", "gs://out-bucket/results/")
+    client = _Client(store)
+    monkeypatch.setattr(pi, "_docai_client_cached", lambda: (client, "processors/p"))
+    monkeypatch.setattr(pi, "_service_account_credentials", lambda: None)
+    return NS(store=store, client=client)
+
+def test_batch_maps_results_by_input_uri(tmp_path, fake_gcloud):
+    files = []
+    for name in ("a.pdf", "x-missing.pdf", "b.png"):
+        (tmp_path / name).write_bytes(b"x")
+        files.append(tmp_path / name)
+
+    out = pi.parse_invoices_docai_batch(files)
+
+    assert set(out) == {files[0], files[2]}
+    assert out[files[0]].number == "B-a.pdf" and out[files[2]].number == "B-b.png"
+    assert out[files[0]].total_gross == 12.3
+    # wejście i wyniki tego przebiegu posprzątane
+    assert fake_gcloud.store == {}
+
+def test_batch_cleans_up_after_failure(tmp_path, fake_gcloud, monkeypatch):
+    (tmp_path / "a.pdf").write_bytes(b"x")
+    monkeypatch.setattr(_Client, "batch_process_documents", lambda self, request: 1 / 0)
+
+    assert pi.parse_invoices_docai_batch([tmp_path / "a.pdf"]) == {}
+    assert fake_gcloud.store == {}
+
+def test_batch_does_not_borrow_results_across_prefixes(tmp_path, fake_gcloud):
+    # dokument 1 bez JSON-a, dokument 10 z wynikiem – prefiks ".../1" nie może złapać ".../10/"
+    names = ["a0.pdf", "n1.pdf"] + [f"a{i}.pdf" for i in range(2, 11)] + ["e11.pdf"]
+    files = []
+    for name in names:
+        (tmp_path / name).write_bytes(b"x")
+        files.append(tmp_path / name)
+
+    out = pi.parse_invoices_docai_batch(files)
+
+    assert files[1] not in out and files[11] not in out
+    assert {f.name: inv.number for f, inv in out.items()} == {n: "B-" + n for n in names[:1] + names[2:11]}
+    assert fake_gcloud.store == {}
+
+def test_batch_cancels_operation_on_timeout(tmp_path, fake_gcloud):
+    (tmp_path / "a.pdf").write_bytes(b"x")
+    fake_gcloud.client.timeout = True
+
+    assert pi.parse_invoices_docai_batch([tmp_path / "a.pdf"]) == {}
+    assert fake_gcloud.client.operations[0].cancelled
+    assert fake_gcloud.store == {}
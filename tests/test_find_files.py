@@ -0,0 +1,7 @@
+from process_invoices import find_new_files
+
+def test_find_new_files_filters_and_sorts(tmp_path):
+    for name in ("b.PDF", "a.jpg", "notes.txt", "noext", ".png"):
+        (tmp_path / name).write_bytes(b"x")
+    (tmp_path / "sub.pdf").mkdir()
+    assert [p.name for p in find_new_files(tmp_path)] == ["a.jpg", "b.PDF"]
@@ -0,0 +1,67 @@
+import os
+from datetime import datetime
+
+import pytest
+
+import process_invoices as pi
+
+@pytest.fixture
+def inbox(tmp_path, monkeypatch):
+    inbox = tmp_path / "inbox"
+    inbox.mkdir()
+    for name in ("a.pdf", "b.png"):
+        (inbox / name).write_bytes(b"x")
+    out = tmp_path / "out.xlsx"
+    monkeypatch.setattr(pi, "_INBOX_RAW", str(inbox))
+    monkeypatch.setattr(pi, "_OUT_RAW", str(out))
+    monkeypatch.setattr(pi, "DRY_RUN", False)
+    monkeypatch.setattr(pi, "_last_hash", None)
+    monkeypatch.setattr(pi, "_have_docai", lambda: False)
+    monkeypatch.setattr(pi, "_have_docai_batch", lambda: False)
+    # stałe "teraz" – numery stubów zależą od czasu
+    fixed = datetime(2025, 9, 10, 12, 0, 0)
+    monkeypatch.setattr(pi, "process_one_file", lambda f, now=None: pi.parse_invoice_stub(f, now=fixed))
+    pi.inbox_dir.cache_clear()
+    pi.out_xlsx_path.cache_clear()
+    yield inbox, out
+    pi.inbox_dir.cache_clear()
+    pi.out_xlsx_path.cache_clear()
+
+@pytest.mark.parametrize("engine", ["raw", "openpyxl"])
+def test_run_once_skips_unchanged_write(inbox, monkeypatch, engine):
+    if engine == "openpyxl":
+        pytest.importorskip("openpyxl")
+    monkeypatch.setattr(pi, "XLSX_ENGINE", engine)
+    inbox_dir, out = inbox
+
+    pi.run_once()
+    assert out.exists()
+    os.utime(out, ns=(0, 0))  # znacznik – nadpisanie pliku go zmieni
+
+    pi.run_once()
+    assert out.stat().st_mtime_ns == 0
+
+    (inbox_dir / "c.jpg").write_bytes(b"x")
+    pi.run_once()
+    assert out.stat().st_mtime_ns != 0
+
+def test_run_once_parses_batch_leftovers_per_file(inbox, monkeypatch):
+    openpyxl = pytest.importorskip("openpyxl")
+    inbox_dir, out = inbox
+    for name in ("c.pdf", "d.pdf", "e.pdf"):
+        (inbox_dir / name).write_bytes(b"x")
+    monkeypatch.setattr(pi, "DOCAI_BATCH_THRESHOLD", 5)
+    monkeypatch.setattr(pi, "_have_docai_batch", lambda: True)
+    # batch zwraca tylko a.pdf; reszta ma przejść przez process_one_file
+    batch_inv = pi.Invoice("B-1", "2025-09-10", "S", "B", "PLN", 0.0, 0.0, 0.0, [])
+    monkeypatch.setattr(pi, "parse_invoices_docai_batch",
+                        lambda files: {f: batch_inv for f in files if f.name == "a.pdf"})
+    seen = []
+    stub = pi.process_one_file
+    monkeypatch.setattr(pi, "process_one_file", lambda f, now=None: seen.append(f.name) or stub(f))
+
+    pi.run_once()
+
+    assert sorted(seen) == ["b.png", "c.pdf", "d.pdf", "e.pdf"]
+    numbers = [r[0] for r in list(openpyxl.load_workbook(out)["Dane"].values)[1:]]
+    assert numbers[0] == "B-1" and len(numbers) == 5
@@ -9,3 +9,74 @@ def test_validate_mismatch():
     data = {"total_net": 100.00, "total_vat": 23.00, "total_gross": 123.00, "line_items":[{"net":99.50,"vat_rate":23,"vat":22.89,"gross":122.39}]}
     ok, errs = validate_totals(data, tol=0.01)
     assert not ok and errs
+
+def test_validate_fast_stops_at_first_mismatch():
+    data = {"total_net": 100.00, "total_vat": 23.00, "total_gross": 123.00, "line_items":[{"net":99.50,"vat_rate":23,"vat":22.89,"gross":122.39}]}
+    ok, errs = validate_totals(data, tol=0.01, fast=True)
+    assert not ok and errs == ["Mismatch net: 99.50 vs 100.00"]
+    ok, errs = validate_totals(data, tol=0.01)
+    assert len(errs) == 3
+
+def test_validate_no_line_items():
+    ok, errs = validate_totals({"total_net": 100.00, "total_vat": 23.00, "total_gross": 123.00, "line_items": []})
+    assert ok and not errs
+
+def test_validate_invoice_from_dataclass():
+    from pathlib import Path
+    from process_invoices import parse_invoice_stub, validate_invoice
+    ok, errs = validate_invoice(parse_invoice_stub(Path("a.pdf")))
+    assert ok and not errs
+
+def test_table_row_with_unreadable_vat():
+    from process_invoices import Invoice, _docai_parse_line_items, validate_invoice
+    text = "Filet2,0010,0020,00n/a24,60"
+    bounds = [(0, 5), (5, 9), (9, 14), (14, 19), (19, 22), (22, 27)]
+    seg = lambda a, b: type("Seg", (), {"start_index": a, "end_index": b})()
+    cell = lambda a, b: type("Cell", (), {"layout": type("L", (), {"text_anchor": type("A", (), {"text_segments": [seg(a, b)]})()})()})()
+    row = type("Row", (), {"cells": [cell(a, b) for a, b in bounds]})()
+    page = type("Page", (), {"tables": [type("T", (), {"body_rows": [row]})()]})()
+    doc = type("Doc", (), {"text": text, "entities": [], "pages": [page]})()
+
+    items = _docai_parse_line_items(doc)
+    assert len(items) == 1 and items[0].description == "Filet"
+    assert items[0].vat == 0.0 and items[0].gross == 24.6
+    inv = Invoice("FV/1", "2025-09-10", "S", "B", "PLN", 20.0, 4.6, 24.6, items)
+    ok, errs = validate_invoice(inv)
+    assert not ok and errs == ["Mismatch vat: 0.00 vs 4.60"]
+
+def test_validate_sub_grosz_items_sum_before_rounding():
+    # każda pozycja zaokrąglona osobno dałaby 4 × 10.12 = 40.48
+    items = [{"net": 10.125, "vat": 0.0, "gross": 10.125}] * 4
+    data = {"total_net": 40.50, "total_vat": 0.0, "total_gross": 40.50, "line_items": items}
+    assert validate_totals(data) == (True, [])
+    assert validate_totals(data, fast=True) == (True, [])
+
+def test_validate_uses_jit_kernel_for_large_invoices(monkeypatch):
+    import math
+    import process_invoices as pi
+    # numba nie jest instalowana w CI – podstawiamy kernel liczący to samo
+    calls = []
+    def sum3(rows):
+        calls.append(len(rows))
+        return tuple(math.fsum(col) for col in zip(*rows))
+    monkeypatch.setattr(pi, "_jit_sum3", lambda: sum3)
+
+    n = pi.NUMBA_MIN_ITEMS
+    rows = [(10.125, 0.0, 10.125)] * n
+    assert pi.validate_totals_fast(10.125 * n, 0.0, 10.125 * n, rows) == (True, [])
+    ok, errs = pi.validate_totals_fast(0.0, 0.0, 10.125 * n, rows)
+    assert not ok and errs == [f"Mismatch net: {10.125 * n:.2f} vs 0.00"]
+    assert calls == [n, n]
+
+    assert pi.validate_totals_fast(10.0, 0.0, 10.0, [(10.0, 0.0, 10.0)]) == (True, [])
+    assert calls == [n, n]  # mała faktura – bez kernela
+
+def test_validate_fast_single_error_on_jit_path(monkeypatch):
+    import math
+    import process_invoices as pi
+    monkeypatch.setattr(pi, "_jit_sum3", lambda: lambda rows: tuple(math.fsum(col) for col in zip(*rows)))
+    for n in (5, 40):  # poniżej i powyżej NUMBA_MIN_ITEMS
+        rows = [(1.0, 0.23, 1.23)] * n
+        ok, errs = pi.validate_totals_fast(0.0, 0.0, 0.0, rows, fast=True)
+        assert not ok and errs == [f"Mismatch net: {n:.2f} vs 0.00"]
+        assert len(pi.validate_totals_fast(0.0, 0.0, 0.0, rows)[1]) == 3
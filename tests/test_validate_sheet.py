@@ -0,0 +1,80 @@
+import importlib
+import random
+from collections import defaultdict
+
+import pytest
+
+pytest.importorskip("pandas")
+
+@pytest.fixture(scope="module")
+def vgs():
+    mp = pytest.MonkeyPatch()
+    mp.setenv("SHEET_ID", "test")  # czytany przy imporcie
+    try:
+        yield importlib.import_module("validate_google_sheet")
+    finally:
+        mp.undo()
+
+def baseline_mismatches(vgs, dane, poz, tol=0.02):
+    """Pierwotna pętla z defaultdict – punkt odniesienia dla wersji pandas."""
+    as_float = vgs.as_float
+    sumy = defaultdict(lambda: {"net": 0.0, "vat": 0.0, "gross": 0.0})
+    for row in poz:
+        if not row: continue
+        inv = row[0]
+        net = as_float(row[6]) if len(row) > 6 else 0.0
+        vat = as_float(row[8]) if len(row) > 8 else None
+        gross = as_float(row[9]) if len(row) > 9 else None
+        if net is not None: sumy[inv]["net"] += net
+        if vat is not None: sumy[inv]["vat"] += vat
+        if gross is not None: sumy[inv]["gross"] += gross
+
+    out = []
+    for row in dane:
+        if not row or len(row) < 9: continue
+        inv = row[0]
+        if inv not in sumy: continue
+        for k, idx in (("net", 6), ("vat", 7), ("gross", 8)):
+            t = as_float(row[idx])
+            if t is not None and abs(sumy[inv][k] - t) > tol:
+                out.append(f"{inv}: sum_{k} {sumy[inv][k]:.2f} != total_{k} {t:.2f}")
+    return out
+
+def poz_row(inv, net="", vat="", gross=""):
+    return [inv, "opis", "", "", "", "", net, "23", vat, gross]
+
+def dane_row(inv, net, vat, gross):
+    return [inv, "S", "PL1", "2025-09-10", "", "PLN", net, vat, gross]
+
+def test_sum_positions_comma_decimals(vgs):
+    sumy = vgs.sum_positions([poz_row("FV1", "0,1", "0,02", "0,12"), poz_row("FV1", "1 000,5", "0.03", "x")])
+    assert sumy.loc["FV1"].round(2).tolist() == [1000.6, 0.05, 0.12]
+
+def test_sum_positions_short_and_unparseable_rows(vgs):
+    sumy = vgs.sum_positions([
+        ["FV1"],                                             # krótki wiersz – liczy się jako net=0
+        ["FV2", "", "", "", "", "", ""],                     # 7 kolumn, nic się nie parsuje
+        ["", "27,63", "32.067", "10.10", "58.22", "17.75", ""],
+        [],
+    ])
+    assert list(sumy.index) == ["FV1"]
+    assert sumy.loc["FV1"].tolist() == [0.0, 0.0, 0.0]
+
+def test_find_mismatches_duplicate_dane_ids(vgs):
+    dane = [dane_row("FV1", "1", "0.23", "1.23"), dane_row("FV1", "2", "0.23", "1.23")]
+    poz = [poz_row("FV1", "1", "0.23", "1.23")]
+    msgs = vgs.find_mismatches(dane, vgs.sum_positions(poz))
+    assert msgs == ["FV1: sum_net 1.00 != total_net 2.00"]
+    assert msgs == baseline_mismatches(vgs, dane, poz)
+
+def test_find_mismatches_matches_baseline_loop(vgs):
+    rnd = random.Random(1)
+    cells = ["", "x", "1", "0,5", "2.25", "1 0", "10.10", "27,63", "-3", None, "0"]
+
+    def row(n):
+        return [rnd.choice(["FV1", "FV2", "", "FV3"])] + [rnd.choice(cells) for _ in range(n - 1)]
+
+    for _ in range(300):
+        dane = [row(rnd.randint(1, 11)) if rnd.random() > .1 else [] for _ in range(rnd.randint(0, 5))]
+        poz = [row(rnd.randint(1, 11)) if rnd.random() > .1 else [] for _ in range(rnd.randint(0, 8))]
+        assert vgs.find_mismatches(dane, vgs.sum_positions(poz)) == baseline_mismatches(vgs, dane, poz), (dane, poz)
@@ -0,0 +1,34 @@
+import pytest
+from pathlib import Path
+
+from process_invoices import parse_invoice_stub, write_to_excel_raw
+
+def test_raw_xlsx_readable(tmp_path):
+    openpyxl = pytest.importorskip("openpyxl")
+    inv = parse_invoice_stub(Path("a&b <1>.pdf"))
+    out = tmp_path / "out.xlsx"
+    write_to_excel_raw([inv], out)
+
+    wb = openpyxl.load_workbook(out)
+    assert wb.sheetnames == ["Dane", "Pozycje", "Koszty_surowcow"]
+    dane = list(wb["Dane"].values)
+    assert dane[0][0] == "number"
+    assert dane[1][0] == inv.number and dane[1][7] == inv.total_gross
+    poz = list(wb["Pozycje"].values)
+    assert len(poz) == 1 + len(inv.line_items)
+    assert poz[1][1] == inv.line_items[0].description
+    assert list(wb["Koszty_surowcow"].values) == [("invoice_number", "category", "amount", "note")]
+
+def test_raw_xlsx_strips_control_chars(tmp_path):
+    openpyxl = pytest.importorskip("openpyxl")
+    from process_invoices import Invoice, LineItem
+    li = LineItem("Filet\x0b z\x01 dorsza\t", 1.0, 10.0, 10.0, 23.0, 2.3, 12.3)
+    inv = Invoice("FV/\x0c1", "2025-09-10", "S", "B", "PLN", 10.0, 2.3, 12.3, [li])
+    out = tmp_path / "out.xlsx"
+    out.write_bytes(b"stary plik")
+    write_to_excel_raw([inv], out)
+
+    wb = openpyxl.load_workbook(out)
+    assert list(wb["Dane"].values)[1][0] == "FV/1"
+    assert list(wb["Pozycje"].values)[1][1] == "Filet z dorsza\t"
+    assert [p.name for p in tmp_path.iterdir()] == ["out.xlsx"]
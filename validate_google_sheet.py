@@ -1,9 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import os, sys, json
-from collections import defaultdict
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
+import pandas as pd
 
 SHEET_ID = os.environ["SHEET_ID"]
 RANGE_DANE = os.environ.get("RANGE_DANE","Dane!A2:K")
@@ -12,6 +10,10 @@ RANGE_POZ  = os.environ.get("RANGE_POZ","Pozycje!A2:J")
 REQUIRED_DANE_COLS = {"invoice_id":0, "supplier_name":1, "supplier_tax_id":2, "issue_date":3, "currency":5, "total_net":6, "total_vat":7, "total_gross":8}
 
 def get_svc():
+    # klient Google importowany dopiero tutaj – sumy/porównania da się testować bez niego
+    from googleapiclient.discovery import build
+    from google.oauth2 import service_account
+
     key = os.environ["GOOGLE_APPLICATION_CREDENTIALS_JSON"]
     info = json.loads(key)
     creds = service_account.Credentials.from_service_account_info(info, scopes=["https://www.googleapis.com/auth/spreadsheets.readonly"])
@@ -26,6 +28,42 @@ def as_float(x):
     except:
         return None
 
+AMOUNTS = ["net", "vat", "gross"]
+
+def to_amounts(df, cols):
+    # as_float per komórka (spacje, przecinki), NaN tam gdzie pusto/nieparsowalne
+    out = df[cols].apply(lambda col: col.map(as_float)).astype("float64")
+    out.columns = AMOUNTS
+    return out
+
+def sum_positions(poz):
+    """Sumy net/vat/gross per faktura z arkusza Pozycje (groupby po kolumnie A)."""
+    rows = [row for row in poz if row]
+    df = pd.DataFrame(rows).reindex(columns=range(10))
+    amounts = to_amounts(df, [6, 8, 9])
+    # faktura trafia do sum dopiero, gdy coś do niej dodano: wiersz krótszy niż
+    # 7 kolumn liczy się jako net=0, wiersz z samymi nieczytelnymi kwotami – wcale
+    short = pd.Series([len(row) <= 6 for row in rows], index=df.index, dtype=bool)
+    keep = short | amounts.notna().any(axis=1)
+    return amounts[keep].groupby(df[0][keep], sort=False).sum()
+
+def find_mismatches(dane, sumy, tol=0.02):
+    """Komunikaty o niezgodnych sumach – w kolejności wierszy Dane, net/vat/gross."""
+    mismatch = []
+    dane_full = [row[:9] for row in dane if row and len(row) >= 9]
+    if dane_full and not sumy.empty:
+        t = pd.DataFrame(dane_full)
+        t = t[t[0].isin(sumy.index)]
+        totals = to_amounts(t, [6, 7, 8])
+        sums = sumy.reindex(t[0]).set_axis(t.index)
+        bad = (sums - totals).abs().gt(tol) & totals.notna()
+        for i in bad.index[bad.any(axis=1)]:
+            inv = t.at[i, 0]
+            for k in AMOUNTS:
+                if bad.at[i, k]:
+                    mismatch.append(f"{inv}: sum_{k} {sums.at[i, k]:.2f} != total_{k} {totals.at[i, k]:.2f}")
+    return mismatch
+
 def main():
     svc = get_svc()
     dane = fetch_values(svc, RANGE_DANE)
@@ -37,31 +75,7 @@ def main():
             if idx >= len(row) or row[idx] in ("", None):
                 missing.append(f"Dane!{r}:{colname} puste")
 
-    sumy = defaultdict(lambda: {"net":0.0,"vat":0.0,"gross":0.0})
-    for row in poz:
-        if not row: continue
-        inv = row[0] if len(row)>0 else ""
-        net = as_float(row[6]) if len(row)>6 else 0.0
-        vat = as_float(row[8]) if len(row)>8 else None
-        gross = as_float(row[9]) if len(row)>9 else None
-        if net is not None: sumy[inv]["net"] += net
-        if vat is not None: sumy[inv]["vat"] += vat
-        if gross is not None: sumy[inv]["gross"] += gross
-
-    tol = 0.02
-    mismatch = []
-    for row in dane:
-        if not row or len(row) < 9: continue
-        inv = row[0]
-        tnet = as_float(row[6]); tvat = as_float(row[7]); tgr = as_float(row[8])
-        if inv in sumy:
-            s = sumy[inv]
-            if tnet is not None and abs(s["net"] - tnet) > tol:
-                mismatch.append(f"{inv}: sum_net {s['net']:.2f} != total_net {tnet:.2f}")
-            if tvat is not None and abs(s["vat"] - tvat) > tol:
-                mismatch.append(f"{inv}: sum_vat {s['vat']:.2f} != total_vat {tvat:.2f}")
-            if tgr is not None and abs(s["gross"] - tgr) > tol:
-                mismatch.append(f"{inv}: sum_gross {s['gross']:.2f} != total_gross {tgr:.2f}")
+    mismatch = find_mismatches(dane, sum_positions(poz))
 
     if missing or mismatch:
         print("VALIDATION FAILED")